@@ -91,6 +91,7 @@ class Agent(BaseAgent):
         """
         action_distribution: Normal
         states: Tuple
+        obs_batch = obs_batch.to(self.model.device)
         with torch.no_grad():
             action_distribution, states, extra_outputs = self.model(obs_batch, state_batch)
 
@@ -170,6 +171,16 @@ class Agent(BaseAgent):
 
         return action_logprobs, values, entropies
 
+    def cuda(self):
+        super().cuda()
+        if self.action_range:
+            self.action_range = tuple(x.cuda() for x in self.action_range)
+
+    def cpu(self):
+        super().cpu()
+        if self.action_range:
+            self.action_range = tuple(x.cpu() for x in self.action_range)
+
 
 class StillAgent(BaseAgent):
     """DEPRECATED
@@ -1,15 +1,52 @@
-from typing import Dict, Any, List, Optional
+import math
+import warnings
+from typing import Dict, Any, List, Optional, Tuple, Callable
 
 import numpy as np
 import torch
-from torch import nn
+from torch import nn, Tensor
 from torch.optim.optimizer import Optimizer
 from torch.utils.tensorboard import SummaryWriter
 
 from agents import Agent
 from preprocessors import simple_padder
 from utils import with_default_config, get_optimizer, DataBatch, Timer, DataBatchT, transpose_batch, AgentDataBatch, \
-    discount_rewards_to_go, masked_mean, get_episode_lens, write_dict, batch_to_gpu, concat_crowd_batch
+    discount_rewards_to_go, masked_mean, write_dict, batch_to_gpu, concat_crowd_batch, \
+    normalize_advantages, record_batch_stream, get_episode_lens_tensor, get_episode_ids
+
+
+@torch.jit.script
+def ppo_loss(logprob_batch: Tensor,
+             old_logprobs_batch: Tensor,
+             advantages_batch: Tensor,
+             value_batch: Tensor,
+             discounted_batch: Tensor,
+             entropy_batch: Tensor,
+             mask: Optional[Tensor],
+             eps: float,
+             value_loss_coeff: float,
+             entropy_coeff: float) -> Tuple[Tensor, Tensor, Tensor]:
+    """
+    Computes the PPO loss in a single scripted function, so that the elementwise operations can be fused.
+
+    Returns:
+        total loss, mean policy loss, mean value loss
+    """
+    # Surrogate loss
+    prob_ratio = torch.exp(logprob_batch - old_logprobs_batch)
+    surr1 = prob_ratio * advantages_batch
+    # surr2 = torch.clamp(prob_ratio, 1. - eps, 1 + eps) * advantages_batch
+    # Same as (1 + eps) * A for A > 0 and (1 - eps) * A otherwise
+    surr2 = advantages_batch + eps * advantages_batch.abs()
+
+    policy_loss = masked_mean(-torch.min(surr1, surr2), mask)
+    value_loss = masked_mean((value_batch - discounted_batch) ** 2, mask)
+
+    loss = (policy_loss
+            + (value_loss_coeff * value_loss)
+            - (entropy_coeff * masked_mean(entropy_batch, mask)))
+
+    return loss, policy_loss, value_loss
 
 
 class CrowdPPOptimizer:
@@ -38,6 +75,10 @@ class CrowdPPOptimizer:
             "ppo_steps": 5,
             "eps": 0.1,  # PPO clip parameter
             "target_kl": 0.01,  # KL divergence limit
+            # How often (in PPO steps) to check the KL limit. Each check syncs with the device, so higher values save
+            # syncs, but may overshoot the limit by a few steps. The first step is never checked, since the weights
+            # there are still the ones used for data collection
+            "kl_check_interval": 1,
             "value_loss_coeff": 0.1,
 
             "entropy_coeff": 0.1,
@@ -48,15 +89,94 @@ class CrowdPPOptimizer:
 
             # GPU
             "use_gpu": False,
+
+            # Specialize the forward pass with torch.compile, padding the batch length to a power of two
+            "compile_forward": False,
         }
         self.config = with_default_config(config, default_config)
 
-        self.optimizer = get_optimizer(self.config["optimizer"])(agent.model.parameters(),
-                                                                 **self.config["optimizer_kwargs"])
+        assert self.config["kl_check_interval"] >= 1, "kl_check_interval must be a positive number of PPO steps"
+
+        # The agent lives on the GPU for the whole training, the optimizer state is then created there as well
+        if self.config["use_gpu"]:
+            self.agent.cuda()
+
+        optimizer_cls = get_optimizer(self.config["optimizer"])
+        optimizer_kwargs = dict(self.config["optimizer_kwargs"])
+        params = list(agent.model.parameters())
+
+        # On GPU, use the fused (single kernel) Adam implementation if this version of torch has it
+        use_fused = (self.config["use_gpu"]
+                     and self.config["optimizer"] in ("adam", "adamw")
+                     and "fused" not in optimizer_kwargs)
+        try:
+            self.optimizer = optimizer_cls(params, **optimizer_kwargs, **({"fused": True} if use_fused else {}))
+        except (TypeError, RuntimeError):
+            if not use_fused:
+                raise
+            self.optimizer = optimizer_cls(params, **optimizer_kwargs)
 
         self.gamma: float = self.config["gamma"]
         self.eps: float = self.config["eps"]
 
+        # Entropy bonus schedule
+        self.entropy_coeff0: float = self.config["entropy_coeff"]
+        self.entropy_decay_time: float = self.config["entropy_decay_time"]
+        self.min_entropy: float = self.config["min_entropy"]
+        self._log01: float = math.log(0.1)
+
+        # Side stream for the host-to-device copies, so that they can overlap with the CPU preprocessing
+        self._copy_stream: Optional[torch.cuda.Stream] = torch.cuda.Stream() if self.config["use_gpu"] else None
+        # Pinned staging buffers for these copies, reused across updates since pinning memory is expensive
+        self._pin_pool: Dict[Tuple[str, torch.dtype], Tensor] = {}
+        # Recorded on the copy stream after each upload, so that the buffers aren't overwritten mid-copy
+        self._copy_done: Optional[torch.cuda.Event] = None
+
+        # Shape-specialized forward pass, if requested and supported by this version of torch
+        self._compiled_evaluate: Optional[Callable] = None
+        if self.config["compile_forward"]:
+            if hasattr(torch, "compile"):
+                self._compiled_evaluate = torch.compile(self.agent.evaluate_actions, dynamic=False)
+            else:
+                warnings.warn("compile_forward is set, but this version of torch has no torch.compile; "
+                              "the forward pass will run eagerly")
+
+    def _evaluate_actions(self, agent_batch: AgentDataBatch) -> Tuple[Tensor, Tensor, Tensor]:
+        """
+        Uses the compiled forward pass if available. The batch length changes with every rollout, so it is padded
+        to the next power of two by repeating the last step, and the outputs for the padding are dropped.
+        This way the compiled function only ever sees a handful of shapes.
+        """
+        if self._compiled_evaluate is None:
+            return self.agent.evaluate_actions(agent_batch)
+
+        size = agent_batch['observations'].shape[0]
+        padded_size = 1 << (size - 1).bit_length()
+        padded_batch = {
+            key: torch.cat([agent_batch[key], agent_batch[key][-1:].expand(padded_size - size,
+                                                                           *agent_batch[key].shape[1:])])
+            for key in ('observations', 'actions')
+        }
+        logprob_batch, value_batch, entropy_batch = self._compiled_evaluate(padded_batch)
+        return logprob_batch[:size], value_batch[:size], entropy_batch[:size]
+
+    def _get_pinned(self, name: str, shape: torch.Size, dtype: torch.dtype) -> Tensor:
+        """
+        Returns a pinned buffer of the requested shape for the given batch field. Each field has its own flat buffer,
+        which only grows when a larger batch comes in, so varying episode lengths don't allocate new memory every time.
+        """
+        # The buffers are overwritten on the host, so the previous upload from them has to be finished first
+        if self._copy_done is not None:
+            self._copy_done.synchronize()
+
+        key = (name, dtype)
+        numel = math.prod(shape)
+        buffer = self._pin_pool.get(key)
+        if buffer is None or buffer.numel() < numel:
+            buffer = torch.empty(numel, dtype=dtype, pin_memory=True)
+            self._pin_pool[key] = buffer
+        return buffer[:numel].view(shape)
+
     def train_on_data(self, data_batch: DataBatch,
                       step: int = 0,
                       writer: Optional[SummaryWriter] = None) -> Dict[str, float]:
@@ -77,8 +197,8 @@ class CrowdPPOptimizer:
         # data_batch: DataBatchT = transpose_batch(data_batch)
 
         entropy_coeff = max(
-            self.config.get("entropy_coeff") * 0.1 ** (step / self.config.get("entropy_decay_time")),
-            self.config.get("min_entropy")
+            self.entropy_coeff0 * math.exp(self._log01 * step / self.entropy_decay_time),
+            self.min_entropy
         )
 
         agent_id = "crowd"
@@ -88,17 +208,34 @@ class CrowdPPOptimizer:
         ####################################### Unpack and prepare the data #######################################
         agent_batch: AgentDataBatch = concat_crowd_batch(data_batch)
 
+        gpu_batch: Optional[AgentDataBatch] = None
         if self.config["use_gpu"]:
-            agent_batch = batch_to_gpu(agent_batch)
-            agent.cuda()
+            # Start the copy on the side stream, it runs while the rewards to go are computed on CPU
+            with torch.cuda.stream(self._copy_stream):
+                gpu_batch = batch_to_gpu(agent_batch, self._get_pinned)
+                self._copy_done = torch.cuda.Event()
+                self._copy_done.record()
 
         # if self.config["pad_sequences"]:
         #     agent_batch, mask = simple_padder(agent_batch)
         #     ep_lens = tuple(mask.sum(0).cpu().numpy())
         # else:
-        mask = torch.ones_like(agent_batch['rewards'])
+        mask: Optional[Tensor] = None  # no padding, every entry is real data
         ep_lens = None
 
+        # Compute discounted rewards to go
+        discounted_batch = discount_rewards_to_go(agent_batch['rewards'],
+                                                  agent_batch['dones'],
+                                                  self.gamma)
+
+        # Move data to GPU if applicable
+        if self.config["use_gpu"]:
+            current_stream = torch.cuda.current_stream()
+            current_stream.wait_stream(self._copy_stream)
+            record_batch_stream(gpu_batch, current_stream)
+            agent_batch = gpu_batch
+            discounted_batch = discounted_batch.cuda()
+
         # Unpacking the data for convenience
 
         # obs_batch = agent_batch['observations']
@@ -108,61 +245,41 @@ class CrowdPPOptimizer:
         done_batch = agent_batch['dones']  # whether the step is the end of an episode
         # state_batch = agent_batch['states']  # hidden LSTM state
 
-        # Evaluate actions to have values that require gradients
-        logprob_batch, value_batch, entropy_batch = agent.evaluate_actions(agent_batch)
-
-        # Compute discounted rewards to go
-        discounted_batch = discount_rewards_to_go(reward_batch,
-                                                  done_batch,
-                                                  self.gamma)
-
-        # Move data to GPU if applicable
-        if self.config["use_gpu"]:
-            discounted_batch = discounted_batch.cuda()
-
-        # breakpoint()
-        # Compute the normalized advantage
-        advantages_batch = (discounted_batch - value_batch).detach()
-        advantages_batch = (advantages_batch - masked_mean(advantages_batch, mask))
-        advantages_batch = advantages_batch / (torch.sqrt(masked_mean(advantages_batch ** 2, mask)) + 1e-8)
-
         # Initialize metrics
-        kl_divergence = 0.
+        kl_divergence = torch.zeros((), device=reward_batch.device)
         ppo_step = -1
-        value_loss = torch.tensor(0)
-        policy_loss = torch.tensor(0)
-        loss = torch.tensor(0)
+        value_loss = torch.zeros((), device=reward_batch.device)
+        policy_loss = torch.zeros((), device=reward_batch.device)
+        loss = torch.zeros((), device=reward_batch.device)
+        entropy_batch = torch.zeros((), device=reward_batch.device)
+        advantages_batch: Optional[Tensor] = None
 
         # Start a timer
         timer.checkpoint()
 
         for ppo_step in range(self.config["ppo_steps"]):
             # Evaluate again after the PPO step, for new values and gradients
-            logprob_batch, value_batch, entropy_batch = agent.evaluate_actions(agent_batch)
+            logprob_batch, value_batch, entropy_batch = self._evaluate_actions(agent_batch)
 
-            # Compute the KL divergence for early stopping
-            kl_divergence = masked_mean(old_logprobs_batch - logprob_batch, mask).item()
-            if kl_divergence > self.config["target_kl"]:
-                break
+            # The weights are unchanged before the first update, so the advantage can reuse this evaluation
+            if ppo_step == 0:
+                # Compute the normalized advantage
+                advantages_batch = normalize_advantages(discounted_batch - value_batch.detach(), mask)
 
-            ######################################### Compute the loss #############################################
-            # Surrogate loss
-            prob_ratio = torch.exp(logprob_batch - old_logprobs_batch)
-            surr1 = prob_ratio * advantages_batch
-            # surr2 = torch.clamp(prob_ratio, 1. - self.eps, 1 + self.eps) * advantages_batch
-            surr2 = torch.where(advantages_batch > 0,
-                                (1 + self.eps) * advantages_batch,
-                                (1 - self.eps) * advantages_batch)
+            # Compute the KL divergence for early stopping, it stays on the device until it's actually checked
+            # The first step uses the same weights as the data collection, so there's nothing to check yet
+            kl_divergence = masked_mean(old_logprobs_batch - logprob_batch, mask)
+            if ppo_step > 0 and ppo_step % self.config["kl_check_interval"] == 0:
+                if kl_divergence.item() > self.config["target_kl"]:
+                    break
 
-            policy_loss = -torch.min(surr1, surr2)
-            value_loss = (value_batch - discounted_batch) ** 2
-
-            loss = (masked_mean(policy_loss, mask)
-                    + (self.config["value_loss_coeff"] * masked_mean(value_loss, mask))
-                    - (entropy_coeff * masked_mean(entropy_batch, mask)))
+            ######################################### Compute the loss #############################################
+            loss, policy_loss, value_loss = ppo_loss(logprob_batch, old_logprobs_batch, advantages_batch,
+                                                     value_batch, discounted_batch, entropy_batch, mask,
+                                                     self.eps, self.config["value_loss_coeff"], entropy_coeff)
 
             ############################################# Update step ##############################################
-            optimizer.zero_grad()
+            optimizer.zero_grad(set_to_none=True)
             loss.backward()
             if self.config["max_grad_norm"] is not None:
                 nn.utils.clip_grad_norm_(agent.model.parameters(), self.config["max_grad_norm"])
@@ -170,25 +287,22 @@ class CrowdPPOptimizer:
 
         ############################################## Collect metrics #############################################
 
-        agent.cpu()
-
         # Training-related metrics
         metrics[f"{agent_id}/time_update"] = timer.checkpoint()
-        metrics[f"{agent_id}/kl_divergence"] = kl_divergence
         metrics[f"{agent_id}/ppo_steps_made"] = ppo_step + 1
-        metrics[f"{agent_id}/policy_loss"] = masked_mean(policy_loss, mask).cpu().item()
-        metrics[f"{agent_id}/value_loss"] = masked_mean(value_loss, mask).cpu().item()
-        metrics[f"{agent_id}/total_loss"] = loss.detach().cpu().item()
-        metrics[f"{agent_id}/total_steps"] = mask.cpu().numpy().sum()
+        metrics[f"{agent_id}/total_steps"] = mask.sum().item() if mask is not None else reward_batch.numel()
 
         # ep_lens = ep_lens if self.config["pad_sequences"] else get_episode_lens(done_batch.cpu())
-        ep_lens = get_episode_lens(done_batch.cpu())
+        # Only the episode lengths are moved to CPU, the scan over dones stays on the device
+        episode_ids = get_episode_ids(done_batch)  # [0, 0, 0, ..., 1, 1, ..., 2, ..., ...]
+        ep_lens = get_episode_lens_tensor(episode_ids).cpu().numpy()
 
         # Group rewards by episode and sum them up to get full episode returns
         # if self.config["pad_sequences"]:
         #     ep_rewards = reward_batch.sum(0)
         # else:
-        ep_rewards = torch.tensor([torch.sum(rewards) for rewards in torch.split(reward_batch, ep_lens)])
+        ep_rewards = torch.zeros(len(ep_lens), dtype=reward_batch.dtype, device=reward_batch.device)
+        ep_rewards.scatter_add_(0, episode_ids, reward_batch)
 
         # Episode length metrics
         metrics[f"{agent_id}/episode_len_mean"] = np.mean(ep_lens)
@@ -197,16 +311,29 @@ class CrowdPPOptimizer:
         metrics[f"{agent_id}/episode_len_max"] = np.max(ep_lens)
         metrics[f"{agent_id}/episode_len_std"] = np.std(ep_lens)
 
-        # Episode reward metrics
-        metrics[f"{agent_id}/episode_reward_mean"] = torch.mean(ep_rewards).item()
-        metrics[f"{agent_id}/episode_reward_median"] = torch.median(ep_rewards).item()
-        metrics[f"{agent_id}/episode_reward_min"] = torch.min(ep_rewards).item()
-        metrics[f"{agent_id}/episode_reward_max"] = torch.max(ep_rewards).item()
-        metrics[f"{agent_id}/episode_reward_std"] = torch.std(ep_rewards).item()
-
         # Other metrics
         metrics[f"{agent_id}/episodes_this_iter"] = len(ep_lens)
-        metrics[f"{agent_id}/mean_entropy"] = torch.mean(entropy_batch).item()
+
+        # Metrics computed on the device, transferred together so that there's only one sync
+        tensor_metrics = {
+            # Training-related metrics
+            f"{agent_id}/kl_divergence": kl_divergence,
+            f"{agent_id}/policy_loss": policy_loss,
+            f"{agent_id}/value_loss": value_loss,
+            f"{agent_id}/total_loss": loss,
+
+            # Episode reward metrics
+            f"{agent_id}/episode_reward_mean": torch.mean(ep_rewards),
+            f"{agent_id}/episode_reward_median": torch.median(ep_rewards),
+            f"{agent_id}/episode_reward_min": torch.min(ep_rewards),
+            f"{agent_id}/episode_reward_max": torch.max(ep_rewards),
+            f"{agent_id}/episode_reward_std": torch.std(ep_rewards),
+
+            # Other metrics
+            f"{agent_id}/mean_entropy": torch.mean(entropy_batch),
+        }
+        tensor_values = torch.stack([value.detach().float() for value in tensor_metrics.values()]).cpu().tolist()
+        metrics.update(zip(tensor_metrics.keys(), tensor_values))
 
         # Write the metrics to tensorboard
         write_dict(metrics, step, writer)
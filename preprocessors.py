@@ -32,8 +32,9 @@ def simple_padder(data_batch: AgentDataBatch) -> Tuple[AgentDataBatch, Tensor]:
             split = torch.split(data_batch[key], ep_lens)
             new_batch[key] = pad_sequence(split, padding_value=0)
 
-    # Get a mask of 1's where there is actual data, and 0's where it's just the padding
-    padded_mask = pad_sequence(torch.split(torch.ones_like(data_batch['actions']), ep_lens))
+    # Get a boolean mask, True where there is actual data, and False where it's just the padding
+    padded_mask = pad_sequence(torch.split(torch.ones_like(data_batch['dones'], dtype=torch.bool), ep_lens),
+                               padding_value=False)
 
     return new_batch, padded_mask
 
@@ -130,7 +130,10 @@ class PPOCrowdTrainer(Trainer):
         # List to keep each agent's mean return as a crude skill approximation
 
         if save_path:
-            torch.save(self.agent.model, os.path.join(save_path, "base_agent.pt"))
+            # The model may be on the GPU for training, checkpoints are always stored on CPU
+            cpu_model = copy.deepcopy(self.agent.model)
+            cpu_model.cpu()
+            torch.save(cpu_model, os.path.join(save_path, "base_agent.pt"))
 
         for step in trange(num_iterations, disable=disable_tqdm):
             ########################################### Collect the data ###############################################
@@ -155,7 +158,7 @@ class PPOCrowdTrainer(Trainer):
             # Save the agent to disk
             if save_path:
                 # torch.save(old_returns, os.path.join(save_path, "returns.pt"))
-                torch.save(self.agent.model.state_dict(),
+                torch.save({key: value.cpu() for key, value in self.agent.model.state_dict().items()},
                            os.path.join(save_path, "saved_weights", f"weights_{step + 1}"))
 
             # Write training time metrics to tensorboard
@@ -1,6 +1,7 @@
 from typing import Dict, List, Union, Tuple, Any, Callable, Type, Optional, Iterator, Sequence
 
 import numpy as np
+from numba import njit, prange
 
 import torch
 from mlagents_envs.environment import UnityEnvironment
@@ -20,6 +21,7 @@ from torch.optim.sgd import SGD
 from collections import defaultdict
 
 from torch.utils.tensorboard import SummaryWriter
+from tensorboard.compat.proto.summary_pb2 import Summary
 
 # TODO: clean this up probably
 
@@ -59,28 +61,45 @@ def with_default_config(config: Dict, default: Dict) -> Dict:
     return config
 
 
+@njit(cache=True, fastmath=True)
+def _discount_rtg_numba(rewards: np.ndarray, dones: np.ndarray, gamma: float) -> np.ndarray:
+    """Backward scan over a flat [T] array of rewards, resetting the return at each episode end"""
+    out = np.empty_like(rewards)
+    g = 0.
+    for t in range(rewards.shape[0] - 1, -1, -1):
+        g = rewards[t] + gamma * g * (1. - dones[t])
+        out[t] = g
+    return out
+
+
+@njit(cache=True, fastmath=True, parallel=True)
+def _discount_rtg_batch_numba(rewards: np.ndarray, gamma: float) -> np.ndarray:
+    """Backward scan over a padded [T, B] array of rewards, each column being a separate episode"""
+    out = np.empty_like(rewards)
+    for b in prange(rewards.shape[1]):
+        g = 0.
+        for t in range(rewards.shape[0] - 1, -1, -1):
+            g = rewards[t, b] + gamma * g
+            out[t, b] = g
+    return out
+
+
 def discount_rewards_to_go(rewards: Tensor, dones: Tensor, gamma: float = 1., batch_mode: bool = False) -> Tensor:
     """
     Computes the discounted rewards to go, handling episode endings. Nothing unusual.
+    The recurrence itself runs in a numba kernel, the tensors are moved to CPU for that.
     """
+    rewards_np = rewards.detach().cpu().numpy()
     if batch_mode:  # for the RNN-compatible case
-        current_reward = 0
-        discounted_rewards = []
-        for reward in rewards.flip(0):
-            current_reward = reward + gamma * current_reward
-            discounted_rewards.insert(0, current_reward)
-        return torch.stack(discounted_rewards)
+        shape = rewards_np.shape
+        discounted_rewards = _discount_rtg_batch_numba(np.ascontiguousarray(rewards_np.reshape(shape[0], -1)), gamma)
+        discounted_rewards = discounted_rewards.reshape(shape)
 
     else:
-        dones = dones.to(torch.int32)  # Torch can't handle reversing boolean tensors
-        current_reward = 0
-        discounted_rewards = []
-        for reward, done in zip(rewards.flip(0), dones.flip(0)):
-            if done:
-                current_reward = 0
-            current_reward = reward + gamma * current_reward
-            discounted_rewards.insert(0, current_reward)
-        return torch.tensor(discounted_rewards)
+        dones_np = dones.detach().cpu().numpy().astype(rewards_np.dtype)
+        discounted_rewards = _discount_rtg_numba(rewards_np, dones_np, gamma)
+
+    return torch.from_numpy(discounted_rewards).to(rewards.device)
 
 
 def discount_td_rewards(rewards_batch: Tensor,
@@ -208,6 +227,33 @@ class Timer:
         return diff
 
 
+def get_episode_ids(done_batch: Tensor) -> Tensor:
+    """
+    Based on the recorded done values, returns the index of the episode each step belongs to, on the same device.
+    Args:
+        done_batch: boolean tensor which values indicate terminal episodes
+
+    Returns:
+        long tensor of episode indices, [0, 0, 0, ..., 1, 1, ..., 2, ..., ...]
+    """
+    dones = done_batch.to(torch.long)
+    return dones.cumsum(dim=0) - dones
+
+
+def get_episode_lens_tensor(episode_ids: Tensor) -> Tensor:
+    """
+    Based on the episode indices from get_episode_ids, returns the length of each episode in a batch.
+    Computed on the device of the input, so that only the episode lengths have to be transferred.
+    Args:
+        episode_ids: long tensor of episode indices
+
+    Returns:
+        long tensor of episode lengths
+    """
+    _, ep_lens_tensor = torch.unique_consecutive(episode_ids, return_counts=True)
+    return ep_lens_tensor
+
+
 def get_episode_lens(done_batch: Tensor) -> Tuple[int]:
     """
     Based on the recorded done values, returns the length of each episode in a batch.
@@ -217,11 +263,7 @@ def get_episode_lens(done_batch: Tensor) -> Tuple[int]:
     Returns:
         tuple of episode lengths
     """
-    episode_indices = done_batch.cpu().cumsum(dim=0)[:-1]
-    episode_indices = torch.cat([torch.tensor([0]), episode_indices])  # [0, 0, 0, ..., 1, 1, ..., 2, ..., ...]
-
-    ep_ids, ep_lens_tensor = torch.unique(episode_indices, return_counts=True)
-    ep_lens = tuple(ep_lens_tensor.cpu().numpy())
+    ep_lens = tuple(get_episode_lens_tensor(get_episode_ids(done_batch)).cpu().numpy())
 
     return ep_lens
 
@@ -249,9 +291,28 @@ def transpose_batch(data_batch: Union[DataBatch, DataBatchT]) -> Union[DataBatch
     return dict(d)
 
 
-def masked_mean(input_: Tensor, mask: Tensor) -> Tensor:
-    """Mean of elements not covered by the mask"""
-    return torch.sum(input_ * mask) / torch.sum(mask)
+def masked_mean(input_: Tensor, mask: Optional[Tensor]) -> Tensor:
+    """
+    Mean of elements not covered by the mask. If the mask is None, it's just the regular mean.
+    The mask is expected to be boolean, 0/1 masks are converted.
+    """
+    if mask is None:
+        return torch.mean(input_)
+    mask = mask.to(torch.bool)  # no-op for boolean masks
+    return torch.masked_select(input_, mask).mean()
+
+
+@torch.jit.script
+def normalize_advantages(advantages: Tensor, mask: Optional[Tensor]) -> Tensor:
+    """Normalizes the advantages to zero mean and unit variance over the elements not covered by the mask"""
+    if mask is None:
+        centered = advantages - advantages.mean()
+        return centered / (centered.pow(2).mean().sqrt() + 1e-8)
+    n = mask.sum().clamp(min=1)
+    mu = (advantages * mask).sum() / n
+    centered = advantages - mu
+    var = (centered * centered * mask).sum() / n
+    return centered / (var.sqrt() + 1e-8)
 
 
 def masked_accuracy(preds: Tensor, labels: Tensor, mask: Tensor) -> float:
@@ -289,18 +350,19 @@ def concat_batches(batches: List[AgentDataBatch]) -> AgentDataBatch:
 
 
 def concat_crowd_batch(batches: DataBatch, exclude: List[str] = None) -> AgentDataBatch:
-    """Concatenate multiple sets of data in a single batch"""
+    """
+    Concatenate multiple sets of data in a single batch.
+    Works directly on the field-major layout produced by the collector, without transposing it first.
+    """
     if exclude is None:
         exclude = ["__all__"]
 
-    batches = transpose_batch(batches)
-
-    batches = {key: value for key, value in batches.items() if key not in exclude}
-    agents = list(batches.keys())
+    first_field = next(iter(batches.values()))
+    agents = [agent_id for agent_id in first_field if agent_id not in exclude]
 
     merged = {}
-    for key in batches[agents[0]]:
-        merged[key] = torch.cat([batch[key] for batch in batches.values()], dim=0)
+    for key, field in batches.items():
+        merged[key] = torch.cat([field[agent_id] for agent_id in agents], dim=0)
 
     return merged
 
@@ -308,11 +370,18 @@ def concat_crowd_batch(batches: DataBatch, exclude: List[str] = None) -> AgentDa
 def write_dict(metrics: Dict[str, Union[int, float]],
                step: int,
                writer: Optional[SummaryWriter] = None):
-    """Writes a dictionary to a tensorboard SummaryWriter"""
+    """
+    Writes a dictionary to a tensorboard SummaryWriter.
+    All the values are packed into a single summary, so that it's serialized and written only once.
+    """
     if writer is not None:
         writer: SummaryWriter
-        for key, value in metrics.items():
-            writer.add_scalar(tag=key, scalar_value=value, global_step=step)
+        if writer.file_writer is None:  # e.g. the writer was closed, let add_scalar handle it
+            for key, value in metrics.items():
+                writer.add_scalar(tag=key, scalar_value=value, global_step=step)
+            return
+        summary = Summary(value=[Summary.Value(tag=key, simple_value=float(value)) for key, value in metrics.items()])
+        writer.file_writer.add_summary(summary, global_step=step)
 
 
 def get_episode_rewards(batch: DataBatch) -> np.ndarray:
@@ -346,16 +415,44 @@ def entropy_center(p: float, n: int) -> float:
     return entropy(probs)
 
 
-def batch_to_gpu(data_batch: AgentDataBatch) -> AgentDataBatch:
+def batch_to_gpu(data_batch: AgentDataBatch,
+                 get_pinned: Optional[Callable[[str, torch.Size, torch.dtype], Tensor]] = None) -> AgentDataBatch:
+    """
+    Copies the batch to the GPU through pinned memory. The copies are non-blocking, so when running on a side stream,
+    the caller has to synchronize with it (and use record_batch_stream) before using the data.
+
+    Args:
+        data_batch: batch of data on CPU
+        get_pinned: optional function returning a reusable pinned staging buffer for a given field name, shape and
+            dtype; if not passed, each tensor is pinned from scratch
+    """
+    def _to_gpu(name: str, tensor: Tensor) -> Tensor:
+        if get_pinned is None:
+            staged = tensor.pin_memory()
+        else:
+            staged = get_pinned(name, tensor.shape, tensor.dtype)
+            staged.copy_(tensor)
+        return staged.to('cuda', non_blocking=True)
+
     new_batch = {}
     for key in data_batch:
         if key == 'states':
-            new_batch[key] = tuple(state_.cuda() for state_ in data_batch[key])
+            new_batch[key] = tuple(_to_gpu(f"{key}_{i}", state_) for i, state_ in enumerate(data_batch[key]))
         else:
-            new_batch[key] = data_batch[key].cuda()
+            new_batch[key] = _to_gpu(key, data_batch[key])
     return new_batch
 
 
+def record_batch_stream(data_batch: AgentDataBatch, stream: torch.cuda.Stream):
+    """Marks all tensors in the batch as used by the stream, so that their memory isn't reused too early"""
+    for key in data_batch:
+        if key == 'states':
+            for state_ in data_batch[key]:
+                state_.record_stream(stream)
+        else:
+            data_batch[key].record_stream(stream)
+
+
 def matrix_diag(diagonal: Tensor):
     N = diagonal.shape[-1]
     shape = diagonal.shape[:-1] + (N, N)